@@ -11,14 +11,15 @@ Implementation Notes
 * adafruit Circuit Python firmware (8.1 +):
     https://github.com/adafruit/circuitpython/releases
 * Adafruit's bys Device library: https://github.com/adafruit/Adafruit_CircuitPython_BusDevice
+* Adafruit's Ticks library: https://github.com/adafruit/Adafruit_CircuitPython_Ticks
 """
 
+import struct
+from array import array
+
 from micropython import const
 from adafruit_bus_device.i2c_device import I2CDevice
-
-from adafruit_register.i2c_struct import Struct, UnaryStruct
-from adafruit_register.i2c_bits import ROBits, RWBits
-from adafruit_register.i2c_bit import ROBit, RWBit
+from adafruit_ticks import ticks_ms, ticks_diff
 
 try:
     import typing
@@ -26,6 +27,13 @@ try:
 except ImportError:
     pass
 
+try:
+    from warnings import warn
+except ImportError:
+    # no warnings module: stay silent rather than block __init__ on a print
+    def warn(message: str) -> None:
+        pass
+
 __version__ = "0.0.1"
 __repo__ = "https://github.com/PyCubed-Mini/CircuitPython_AD7291.git"
 
@@ -36,7 +44,7 @@ _T_SENSE_CONVERSION_RESULT = const(0x02)
 _T_SENSE_AVERAGE_RESULT = const(0x03)
 _CH0_DATA_HIGH = const(0x04)
 _CH0_DATA_LOW = const(0x05)
-_CH0_HYSTERESIS = const(0X06)
+_CH0_HYSTERESIS = const(0x06)
 _CH1_DATA_HIGH = const(0x07)
 _CH1_DATA_LOW = const(0x08)
 _CH2_DATA_HIGH = const(0x0A)
@@ -54,16 +62,71 @@ _CH7_DATA_LOW = const(0x1A)
 _T_SENSE_DATA_HIGH = const(0x1C)
 _T_SENSE_DATA_LOW = const(0x1D)
 
-
-_DEFAULT_ADDRESS = 0x2F
+# DATA_HIGH / DATA_LOW register of each channel, indexed by channel number.
+# index 8 is the temperature sensor. Stored as bytes so each table is a
+# single small object and indexing yields the address as an int
+_CH_HIGH_REGS = bytes((_CH0_DATA_HIGH, _CH1_DATA_HIGH, _CH2_DATA_HIGH,
+                       _CH3_DATA_HIGH, _CH4_DATA_HIGH, _CH5_DATA_HIGH,
+                       _CH6_DATA_HIGH, _CH7_DATA_HIGH, _T_SENSE_DATA_HIGH))
+_CH_LOW_REGS = bytes((_CH0_DATA_LOW, _CH1_DATA_LOW, _CH2_DATA_LOW,
+                      _CH3_DATA_LOW, _CH4_DATA_LOW, _CH5_DATA_LOW,
+                      _CH6_DATA_LOW, _CH7_DATA_LOW, _T_SENSE_DATA_LOW))
+# DATA_HIGH, DATA_LOW pairs of every channel, in read_all_limits order
+_LIMIT_REGS = bytes(reg for pair in zip(_CH_HIGH_REGS, _CH_LOW_REGS)
+                    for reg in pair)
+# struct format decoding one word per register of _LIMIT_REGS
+_LIMIT_FMT = ">%dH" % len(_LIMIT_REGS)
+
+# immutable pointer writes for the registers read on fixed paths
+_VOLTAGE_CONVERSION_PTR = bytes((_VOLTAGE_CONVERSION,))
+_LIMIT_PTRS = tuple(bytes((reg,)) for reg in _LIMIT_REGS)
+
+# command register channel bits, D15 (CH0) through D8 (CH7)
+_BIT = b"\x80\x40\x20\x10\x08\x04\x02\x01"
+# default channel selection, a tuple so it can be shared safely
+_ALL_OFF = (False,) * 8
+# command register settings bits, D7-D0
+_TSENSE_BIT = const(0x80)
+_NOISE_DELAY_BIT = const(0x20)
+
+# result and limit words: channel tag in D[12:16], data in D[0:12]
+_TAG_SHIFT = const(12)
+_DATA_MASK = const(0x0FFF)
+
+_DEFAULT_ADDRESS = const(0x2F)
+
+
+def _reg(channel: int, high: bool) -> int:
+    """DATA_HIGH or DATA_LOW register address of a channel (0-8)"""
+    if not 0 <= channel <= 8:
+        raise ValueError("invalid channel")
+    return (_CH_HIGH_REGS if high else _CH_LOW_REGS)[channel]
+
+
+def _check_out(out: array, n: int) -> None:
+    """Raises ValueError unless out holds exactly n result words"""
+    if len(out) != n:
+        raise ValueError("out must hold %d words" % n)
+
+
+def _unpack_words(buf: bytearray, out: array, n: int) -> None:
+    """
+    Packs the first n big-endian words of buf into out. Kept as a free
+    function working on locals only, so the loop does no attribute
+    lookups
+    """
+    for i in range(n):
+        out[i] = (buf[2 * i] << 8) | buf[2 * i + 1]
 
 
 class AD7291:
     """Driver for the AD7291 SAR ADC"""
 
+    # the AD7291 supports fast mode I2C, reads are bus bound below this
+    RECOMMENDED_FREQUENCY = 400_000
+
     def __init__(self, i2c: I2C, addr: int = _DEFAULT_ADDRESS,
-                 number_of_active_channels: int = 0,
-                 active_channels: list = [False] * 8,
+                 active_channels: list = None,
                  enable_temp_conversions: bool = False,
                  enable_noise_delay: bool = False) -> None:
         """
@@ -73,117 +136,420 @@ class AD7291:
         Properties
         -----------------
 
-        i2c: the i2c bus being used
+        i2c: the i2c bus being used. Construct it with
+        frequency=AD7291.RECOMMENDED_FREQUENCY (400 kHz) or faster, at the
+        100 kHz default every read spends ~4x longer on the bus
         addr: the i2c address of the ad7291 in your hardware
 
         active_channels: a bool list of length 8 representing which
         voltage input channels of the ad7291 should be read. Index
         in this list corresponds to channel number. Index 0 is CH0,
-        index 1 is CH1 and so on
+        index 1 is CH1 and so on. The number of active channels is
+        derived from this list
         """
         self.i2c_device = I2CDevice(i2c, addr)
 
-        self.active_channels = active_channels
+        frequency = getattr(i2c, "frequency", None)
+        if frequency is not None and frequency < self.RECOMMENDED_FREQUENCY:
+            warn("I2C bus runs at %d Hz, the AD7291 supports %d Hz"
+                 % (frequency, self.RECOMMENDED_FREQUENCY))
+
+        if active_channels is None:
+            active_channels = _ALL_OFF
+
+        # register pointer byte for reads of a register chosen at runtime,
+        # kept apart so it never aliases self.buf
+        self._ptr_buf = bytearray(1)
+        # single register word, kept out of self.buf so it can be read
+        # in the same bus lock as the voltages
+        self._word_buf = bytearray(2)
+        # register address plus one 16 bit word, patched in place by
+        # every register write including the command register
+        self._cmd_buf = bytearray(3)
+        # register the address pointer was last left at, so _read_reg16
+        # can skip rewriting it. None whenever it is unknown
+        self._last_ptr = None
+        # DATA_HIGH and DATA_LOW words of every channel, see read_all_limits
+        self._bulk_res = bytearray(2 * len(_LIMIT_REGS))
+        # one view per word of _bulk_res, taken once so the scan neither
+        # slices nor passes start/end arguments per register
+        self._bulk_mv = memoryview(self._bulk_res)
+        self._bulk_words = tuple(self._bulk_mv[i:i + 2]
+                                 for i in range(0, len(self._bulk_res), 2))
+
+        # read_from_voltage returns its last result again when called
+        # within min_interval_ms of the read that produced it
+        self.min_interval_ms = 1
+        self._last_read = None
+        self._last_read_ts = 0
+
+        # self.channels and self.settings shadow the upper and lower byte
+        # of the command register, which is only ever written as a whole
+        settings = ((_TSENSE_BIT if enable_temp_conversions else 0)
+                    | (_NOISE_DELAY_BIT if enable_noise_delay else 0))
+        self.active_channels = [False] * 8
+        self.num_active_channels = None
+        channels = self.channel_list_to_bits(active_channels)
+        with self.i2c_device as i2c:
+            self._write_command(i2c, channels, settings)
+
+    def enable_channels(self, channels: int, flags: int = None) -> None:
         """
-        set the channel bits in the command register to correspond
-        with the active_channels list
+        Selects the voltage channels to convert. channels is the D15-D8
+        byte of the command register: bit 7 is CH0, bit 0 is CH7. flags,
+        when given, replaces the D7-D0 settings byte in the same write
         """
+        if flags is None:
+            flags = self.settings
+        with self.i2c_device as i2c:
+            self._write_command(i2c, channels, flags)
 
-        self.channels = self.channel_list_to_bits(active_channels)
-        self.tsense = enable_temp_conversions
-        self.noise = enable_noise_delay
-        self.num_active_channels = number_of_active_channels
+    def configure_and_read(self, channels: int, out: array = None) -> array:
+        """
+        Enables channels like enable_channels, then reads their
+        conversion results like read_voltages, holding the bus lock once
+        for the command register write and the read. A caller's out is
+        checked against the new channel count before the chip is touched
+        """
+        if out is not None:
+            _check_out(out, sum(1 for bit in _BIT if channels & bit))
 
-        self.settings = 0x00
-        if self.tsense:
-            print("tsense enabled")
-            self.settings += 1 << 7
-        if self.noise:
-            self.settings += 1 << 5
+        with self.i2c_device as i2c:
+            self._write_command(i2c, channels, self.settings)
+            self._read_conversions(i2c)
 
-        # initialize a buffer to interact with i2c
-        self.buf = bytearray(2 * self.num_active_channels)
+        if out is None:
+            out = self._voltages
+        _unpack_words(self.buf, out, self.num_active_channels)
+        return out
 
-        with self.i2c_device as device:
-            self.buf[0] = _COMMAND_REGISTER
-            self.buf[1] = self.channels
-            self.buf[2] = self.settings
+    def _set_channels(self, channels: int) -> None:
+        """
+        Updates the channel shadow and everything sized by the number of
+        active channels. Only done on reconfiguration, reads reuse these
+        buffers. The buffers are only reallocated when the number of
+        active channels changes
+        """
+        self.channels = channels
+        for i, bit in enumerate(_BIT):
+            self.active_channels[i] = bool(channels & bit)
+        num_active_channels = sum(self.active_channels)
+        if num_active_channels == self.num_active_channels:
+            return
+        self.num_active_channels = num_active_channels
+
+        # receive buffer for the voltage conversion results, sized
+        # exactly, but never empty so a read always has a word to fill
+        self.buf = bytearray(2 * self.num_active_channels or 2)
+        # struct format of the voltage conversion words in self.buf
+        self._fmt = ">%dH" % self.num_active_channels
+        # default output of read_voltages, one packed word per channel
+        self._voltages = array("H", [0] * self.num_active_channels)
+
+    def _write_command(self, i2c: I2CDevice, channels: int,
+                       settings: int) -> None:
+        """
+        Writes the command register: channels into D15-D8, settings into
+        D7-D0. The channel and settings shadows are only updated once the
+        write went through, so they always match the chip and the register
+        is never read back. i2c must already be locked by the caller
+        """
+        if not 0 <= channels <= 0xFF:
+            raise ValueError("invalid channels")
+        if not 0 <= settings <= 0xFF:
+            raise ValueError("invalid flags")
+
+        self.invalidate()
+        self._write_reg16(i2c, _COMMAND_REGISTER, (channels << 8) | settings)
+        self.settings = settings
+        self._set_channels(channels)
+
+    def _write_settings(self, settings: int) -> None:
+        """Writes the command register with new settings bits"""
+        with self.i2c_device as i2c:
+            self._write_command(i2c, self.channels, settings)
 
-            device.write(self.buf, end=3)
+    @property
+    def tsense(self) -> bool:
+        """Whether temperature conversions are enabled"""
+        return bool(self.settings & _TSENSE_BIT)
+
+    @tsense.setter
+    def tsense(self, enable: bool) -> None:
+        if enable:
+            self._write_settings(self.settings | _TSENSE_BIT)
+        else:
+            self._write_settings(self.settings & ~_TSENSE_BIT)
 
-    def channel_list_to_bits(self, channel_list: list = [False] * 8) -> int:
+    @property
+    def noise(self) -> bool:
+        """Whether noise-delayed sampling is enabled"""
+        return bool(self.settings & _NOISE_DELAY_BIT)
+
+    @noise.setter
+    def noise(self, enable: bool) -> None:
+        if enable:
+            self._write_settings(self.settings | _NOISE_DELAY_BIT)
+        else:
+            self._write_settings(self.settings & ~_NOISE_DELAY_BIT)
+
+    def channel_list_to_bits(self, channel_list: list = None) -> int:
         """
         takes the input list, should be a bool list, and converts it
         into an integer that will be passed into bits D15-D8 of
         command register
         """
+        if channel_list is None or channel_list is _ALL_OFF:
+            return 0
         result = 0
-        for i, channel in enumerate(channel_list):
+        for channel, bit in zip(channel_list, _BIT):
             if channel:
-                result += 1 << (7 - i)        # set ith channel bit to 1
-        return result & ((i << 8) - 1)
+                result |= bit
+        return result
 
-    @property
-    def read_from_voltage(self):
-        """Initialize return list"""
-        res = [None] * self.num_active_channels
+    def read_from_voltage(self) -> tuple:
+        """
+        Reads the voltage conversion results of the active channels as a
+        tuple of (channel, voltage) tuples, voltage being the raw 12 bit
+        conversion. Calls within min_interval_ms of the last read return
+        the same tuple without touching the bus, so it is immutable and
+        safe to share between consumers
+        """
+        now = ticks_ms()
+        if (self._last_read is not None
+                and ticks_diff(now, self._last_read_ts) < self.min_interval_ms):
+            return self._last_read
+
+        with self.i2c_device as i2c:
+            self._read_conversions(i2c)
+
+        """
+        Each big-endian 16 bit word holds the channel address in bits
+        15-12 and the converted voltage in bits 11-0. All words are
+        unpacked with one struct call and split with plain bit ops
+        """
+        words = struct.unpack_from(self._fmt, self.buf)
+        res = tuple((w >> _TAG_SHIFT, w & _DATA_MASK) for w in words)
+        for channel, _ in res:
+            if channel > 7:                             # D[12:16]
+                raise BufferError("Channel returned is not a voltage channel (0-7)")
+
+        self._last_read = res
+        self._last_read_ts = now
+        return res
 
-        self.buf[0] = _VOLTAGE_CONVERSION
+    def read_voltages(self, out: array = None) -> array:
+        """
+        Reads the voltage conversion results of the active channels into
+        out, or into a buffer owned by the driver when out is None, and
+        returns it. Each entry is the packed 16 bit result word: channel
+        address in bits 15-12 and the 12 bit conversion in bits 11-0.
+        Nothing is allocated per call, so this is the method to poll in
+        a loop. The returned driver buffer is overwritten by the next call,
+        and replaced by a new one whenever enable_channels or
+        configure_and_read changes the number of active channels. A
+        caller's out must hold exactly one word per active channel
+        """
+        if out is None:
+            out = self._voltages
+        else:
+            _check_out(out, self.num_active_channels)
 
         with self.i2c_device as i2c:
-            i2c.write(self.buf, end=1)
+            self._read_conversions(i2c)
+        _unpack_words(self.buf, out, self.num_active_channels)
+        return out
 
+    def read_all(self, voltages_out: array = None,
+                 temp_out: list = None) -> array:
         """
-        Voltages are returned sequentially, so we readinto using our
-        entire buffer of (2 * num_active_channel) bytes
+        Reads the voltage conversion results like read_voltages and, when
+        temp_out is given, the temperature conversion in degrees C into
+        temp_out[0]. Both reads are done while holding the bus lock once.
+        Returns the voltage buffer
         """
+        if voltages_out is None:
+            voltages_out = self._voltages
+        else:
+            _check_out(voltages_out, self.num_active_channels)
+        if temp_out is not None and not self.settings & _TSENSE_BIT:
+            raise BufferError("Temperature sensor not enabled")
+
         with self.i2c_device as i2c:
-            i2c.readinto(self.buf)
+            self._read_conversions(i2c)
+            if temp_out is not None:
+                word = self._read_reg16(i2c, _T_SENSE_CONVERSION_RESULT)
+
+        _unpack_words(self.buf, voltages_out, self.num_active_channels)
+        if temp_out is not None:
+            temp_out[0] = self._decode_temperature(word)
+        return voltages_out
 
+    def _read_conversions(self, i2c: I2CDevice) -> None:
         """
-        For each 2 byte sequence, we first get bits 15-12 which represent the
-        channel address, we then get bits 11-0 which represent the converted
-        voltage read.
+        Voltages are returned sequentially, so we readinto using our
+        entire buffer of (2 * num_active_channel) bytes. The pointer
+        write and the read share one repeated-START transaction.
+        i2c must already be locked by the caller
         """
-        for i in range(0, 2 * self.num_active_channels, 2):
-            channel = (self.buf[i] >> 4) & ((1 << 4) - 1)    # D[12:16]
-            if not 0 <= channel <= 7:
-                BufferError("Channel returned is not a voltage channel (0-7)")
+        # always re-addressed, so never recorded as the current pointer
+        self._last_ptr = None
+        i2c.write_then_readinto(_VOLTAGE_CONVERSION_PTR, self.buf)
 
-            # the conversion from the voltage read
-            voltage = (self.buf[i]) & ((1 << 4) - 1)         # D[8:12]
-            voltage = voltage << 8                                     # shift to make room
-            voltage += self.buf[i + 1]                       # D[0:8]
-            res[int(i/2)] = (channel, voltage)
+    def _read_reg16(self, i2c: I2CDevice, reg: int) -> int:
+        """
+        Reads one 16 bit register in a single repeated-START transaction,
+        or with a bare read when the address pointer is already at reg.
+        The voltage conversion register streams its results, so it is
+        always re-addressed and never recorded as the current pointer.
+        i2c must already be locked by the caller
+        """
+        if self._last_ptr == reg:
+            i2c.readinto(self._word_buf)
+        else:
+            self._ptr_buf[0] = reg
+            self._last_ptr = None
+            i2c.write_then_readinto(self._ptr_buf, self._word_buf)
+            if reg != _VOLTAGE_CONVERSION:
+                self._last_ptr = reg
+        return int.from_bytes(self._word_buf, "big")
+
+    def _write_reg16(self, i2c: I2CDevice, reg: int, value: int) -> None:
+        """
+        Writes one 16 bit register. i2c must already be locked by the
+        caller
+        """
+        self._cmd_buf[0] = reg
+        self._cmd_buf[1] = (value >> 8) & 0xFF
+        self._cmd_buf[2] = value & 0xFF
+        self._last_ptr = None
+        i2c.write(self._cmd_buf)
 
-        return res
+    def invalidate(self) -> None:
+        """Forces the next read_from_voltage to read from the device"""
+        self._last_read = None
 
-    @property
-    def read_temperature_conversion(self):
+    def read_temperature_conversion(self) -> float:
         """
         Reads the latest temperature conversion off of the temperatuve
         conversion register. Temperature conversions are done every ~5ms
         so it is not gauranteed to be a new measurement if retrieved
         multiple times within a 5ms window.
         """
-        if not self.settings >> 7:
-            BufferError("Temperature sensor not enabled")
+        if not self.settings & _TSENSE_BIT:
+            raise BufferError("Temperature sensor not enabled")
 
-        self.buf[0] = _T_SENSE_CONVERSION_RESULT
         with self.i2c_device as i2c:
-            i2c.write(self.buf, end=1)
+            word = self._read_reg16(i2c, _T_SENSE_CONVERSION_RESULT)
 
-            i2c.readinto(self.buf, end=2)
+        return self._decode_temperature(word)
 
-        channel = (self.buf[0] >> 4) & ((1 << 4) - 1)   # D[12:16]
-        if (channel != 8):
-            BufferError("Channel returned is not Temperature Channel (8)")
+    def _decode_temperature(self, word: int) -> float:
+        """Converts a temperature conversion result word to degrees C"""
+        if word >> _TAG_SHIFT != 8:                     # D[12:16]
+            raise BufferError("Channel returned is not Temperature Channel (8)")
+        return self.raw_to_celsius(word)
 
-        temperature = (self.buf[0]) & ((1 << 4) - 1)    # D[8:12]
-        temperature = temperature << 8                                # shifts
-        temperature += self.buf[1]                      # D[0:8]
+    @staticmethod
+    def raw_to_celsius(word: int) -> float:
+        """
+        Converts a raw T_SENSE register word to degrees C. D[0:12] is a
+        two's complement value in steps of 0.25 C, the upper bits are
+        ignored
+        """
+        temperature = word & _DATA_MASK
+        if temperature & 0x0800:
+            temperature -= 4096
+        return temperature * 0.25
 
-        if temperature > 4096:
-            return (4096 - temperature)/4
-        else:
-            return temperature/4
+    def read_average_temperature(self) -> float:
+        """
+        Reads the T_SENSE average result register, the running average
+        of the temperature conversions, in degrees C
+        """
+        if not self.settings & _TSENSE_BIT:
+            raise BufferError("Temperature sensor not enabled")
+
+        with self.i2c_device as i2c:
+            word = self._read_reg16(i2c, _T_SENSE_AVERAGE_RESULT)
+        return self._decode_temperature(word)
+
+    def get_channel(self, polarity: str, channel: int) -> int:
+        """
+        Returns the address of the DATA_HIGH (polarity "high") or
+        DATA_LOW (polarity "low") register of a channel. Channels 0-7
+        are the voltage channels, channel 8 is the temperature sensor.
+        """
+        return _reg(channel, polarity == "high")
+
+    def read_channel_limit(self, channel: int, high: bool = True) -> int:
+        """
+        Reads the 12 bit DATA_HIGH (high=True) or DATA_LOW alert limit of
+        a single channel
+        """
+        reg = _reg(channel, high)
+        with self.i2c_device as i2c:
+            return self._read_reg16(i2c, reg) & _DATA_MASK
+
+    def get_channel_limits(self, channel: int) -> tuple:
+        """
+        Reads the alert limits of a channel, returned as (low, high).
+        Limits are 12 bit values in the same units as the conversion
+        results.
+        """
+        high_reg = _reg(channel, True)
+        low_reg = _reg(channel, False)
+
+        """
+        The AD7291 does not auto-increment its address pointer, so the
+        two registers are still addressed separately, but both reads
+        share one bus lock
+        """
+        with self.i2c_device as i2c:
+            high = self._read_reg16(i2c, high_reg) & _DATA_MASK  # D[0:12]
+            low = self._read_reg16(i2c, low_reg) & _DATA_MASK    # D[0:12]
+
+        return (low, high)
+
+    def read_many(self, regs, out: array = None) -> array:
+        """
+        Reads the raw 16 bit word of every register address in regs,
+        holding the bus lock once for the whole batch. Results go into
+        out, or a new array when out is None, in the order of regs
+        """
+        if out is None:
+            out = array("H", [0] * len(regs))
+        with self.i2c_device as i2c:
+            for i, reg in enumerate(regs):
+                out[i] = self._read_reg16(i2c, reg)
+        return out
+
+    def read_all_limits(self) -> tuple:
+        """
+        Reads the alert limits of CH0-CH7 and the temperature sensor as a
+        tuple of nine (low, high) pairs, indexed by channel number.
+        Every register still needs its own pointer write, but the whole
+        scan holds the bus lock once and is decoded by one struct call
+        """
+        self._last_ptr = None
+        with self.i2c_device as i2c:
+            for ptr, word in zip(_LIMIT_PTRS, self._bulk_words):
+                i2c.write_then_readinto(ptr, word)
+
+        words = struct.unpack_from(_LIMIT_FMT, self._bulk_mv)
+        return tuple((words[i + 1] & _DATA_MASK, words[i] & _DATA_MASK)
+                     for i in range(0, len(words), 2))
+
+    def _set_channel_limit(self, reg: int, value: int) -> None:
+        if not 0 <= value < (1 << 12):
+            raise ValueError("invalid limit")
+        with self.i2c_device as i2c:
+            self._write_reg16(i2c, reg, value)
+
+    def set_channel_upper_limit(self, channel: int, value: int) -> None:
+        """Sets the 12 bit DATA_HIGH alert limit of a channel"""
+        self._set_channel_limit(_reg(channel, True), value)
+
+    def set_channel_lower_limit(self, channel: int, value: int) -> None:
+        """Sets the 12 bit DATA_LOW alert limit of a channel"""
+        self._set_channel_limit(_reg(channel, False), value)
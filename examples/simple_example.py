@@ -1,9 +1,11 @@
 import ad7291
 import board
+import busio
 import time
 
-# create I2C bus
-i2c = board.I2C()   # uses board.SCL and board.SDA
+# create I2C bus in fast mode, the AD7291 supports 400 kHz
+i2c = busio.I2C(board.SCL, board.SDA,
+                frequency=ad7291.AD7291.RECOMMENDED_FREQUENCY)
 
 """
 initialize an ad7291
@@ -11,11 +13,10 @@ this example has 1 active channel
 the 1st index in active_channels is set to true
 indicating that the 1st channel is active
 """
-ad = ad7291.AD7291(i2c, number_of_active_channels=1,
-                   active_channels=[False, True, False,
-                                    False, False, False,
-                                    False, False])
+ad = ad7291.AD7291(i2c, active_channels=[False, True, False,
+                                          False, False, False,
+                                          False, False])
 
 while True:
-    print(ad.read_from_voltage)
+    print(ad.read_from_voltage())
     time.sleep(1)